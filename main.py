@@ -2,28 +2,92 @@ from fastapi import FastAPI, Header, HTTPException
 from fastapi.responses import HTMLResponse
 from pydantic import BaseModel
 from typing import Optional, List
-import os, re, requests
+from cachetools import TTLCache
+from contextlib import asynccontextmanager
+import asyncio, functools, hmac, os, re, httpx, orjson
 
 # =========================================================
 # APP CONFIG
 # =========================================================
-app = FastAPI(title="RAKSHAK AI – Agentic Scam Honeypot")
 API_KEY = os.getenv("API_KEY", "rakshak-secret-key")
+API_KEY_BYTES = API_KEY.encode()
 GUVI_CALLBACK = "https://hackathon.guvi.in/api/updateHoneyPotFinalResult"
 
+# Shared client: keeps the callback connection alive and never blocks the loop.
+# Callbacks run in the background; cap how many are in flight during bursts.
+CALLBACK_CONCURRENCY = 32
+CALLBACK_CLIENT = None
+CALLBACK_LIMIT = None
+PENDING_CALLBACKS = set()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global CALLBACK_CLIENT, CALLBACK_LIMIT
+    # Built per lifespan so they bind to the running loop and a restarted app
+    # never reuses a client closed by the previous shutdown
+    CALLBACK_CLIENT = httpx.AsyncClient(
+        timeout=5.0,
+        limits=httpx.Limits(
+            max_connections=CALLBACK_CONCURRENCY,
+            max_keepalive_connections=CALLBACK_CONCURRENCY
+        )
+    )
+    CALLBACK_LIMIT = asyncio.Semaphore(CALLBACK_CONCURRENCY)
+    yield
+    # Let in-flight callbacks finish before the shared client is closed
+    await asyncio.gather(*PENDING_CALLBACKS, return_exceptions=True)
+    await CALLBACK_CLIENT.aclose()
+
+app = FastAPI(
+    title="RAKSHAK AI – Agentic Scam Honeypot",
+    lifespan=lifespan
+)
+
+# Constant-time compare; bytes so non-ASCII header values can't raise
+def api_key_valid(x_api_key: Optional[str]):
+    return x_api_key is not None and hmac.compare_digest(x_api_key.encode(), API_KEY_BYTES)
+
 # =========================================================
 # MEMORY + STATS
 # =========================================================
-SESSION_INTEL = {}
-SESSION_CALLBACK_SENT = set()
+# Bounded so a long-running honeypot can't grow forever. TTLCache counts from
+# the last write, so hackathon_api() re-sets a session's keys on every turn to
+# make the TTL an idle timeout. Callback-sent markers are tiny and must outlive
+# the session's intel, or a returning session would get a second final-result
+# callback, so they get a 10x larger bound and a day's TTL.
+SESSION_MAX = 10_000
+SESSION_TTL = 3600
+SESSION_INTEL = TTLCache(maxsize=SESSION_MAX, ttl=SESSION_TTL)
+SESSION_CALLBACK_SENT = TTLCache(maxsize=SESSION_MAX * 10, ttl=SESSION_TTL * 24)
 STATS = {"total": 0, "scam": 0, "safe": 0}
 
 # =========================================================
 # PATTERNS
 # =========================================================
-UPI_REGEX = r"[\w.-]+@[\w.-]+"
-URL_REGEX = r"https?://[^\s]+"
-PHONE_REGEX = r"\+?\d{10,13}"
+# UPI_RE has no literal prefix, so re tries it at every offset; callers check
+# for the mandatory "@" first and skip the regex when it's absent.
+UPI_RE = re.compile(r"[\w.-]+@[\w.-]+")
+URL_RE = re.compile(r"https?://\S+")
+PHONE_RE = re.compile(r"\+?\d{10,13}")
+
+# (weight, phrases) – each signal scores once, whichever phrase matched
+SCAM_SIGNALS = [
+    (6, ["otp"]),
+    (6, ["upi"]),
+    (5, ["account blocked"]),
+    (4, ["verify"]),
+    (5, ["send money"]),
+    (4, ["urgent", "immediately", "today"]),
+]
+SIGNAL_OF = {k: i for i, (_, ks) in enumerate(SCAM_SIGNALS) for k in ks}
+FULL_CONFIDENCE_SCORE = 12
+
+LINK_CONTEXT_KEYWORDS = ["verify", "bank", "account", "login", "click"]
+
+SUSPICIOUS_KEYWORDS = [
+    "otp","upi","verify","account blocked",
+    "urgent","immediately","click","bank"
+]
 
 # =========================================================
 # MODELS
@@ -50,47 +114,62 @@ class HoneypotResponse(BaseModel):
 # =========================================================
 # 🔥 FINAL FIXED DETECTION LOGIC
 # =========================================================
-def detect(msg: str):
-    msg = msg.lower().strip()
+def detect(msg: str, lowered: bool = False):
+    if not lowered:
+        msg = msg.lower()
+    msg = msg.strip()
+    # Nothing shorter than "otp" / "a@b" can score, so "hi" / "ok" skip the pipeline
+    if len(msg) < 3:
+        return False, 0.0
+    # Only short messages are cached; the key is the whole message, so caching
+    # arbitrarily large bodies would let callers pin them in memory
+    if len(msg) > DETECT_CACHE_MAX_LEN:
+        return detect_normalized(msg)
+    return detect_cached(msg)
+
+def detect_normalized(msg: str):
     score = 0
 
     # HARD SCAM SIGNALS
-    if "otp" in msg: score += 6
-    if "upi" in msg or "upi id" in msg: score += 6
-    if "account blocked" in msg: score += 5
-    if "verify" in msg: score += 4
-    if "send money" in msg: score += 5
-    if "urgent" in msg or "immediately" in msg or "today" in msg:
-        score += 4
+    hits = {i for k, i in SIGNAL_OF.items() if k in msg}
+    score += sum(SCAM_SIGNALS[i][0] for i in hits)
+
+    # Later checks only add to the score, so once confidence is saturated
+    # the regex scans below cannot change the verdict
+    if score >= FULL_CONFIDENCE_SCORE:
+        return True, 1.0
 
     # PHISHING LINK LOGIC (IMPORTANT FIX)
-    if re.search(URL_REGEX, msg):
+    if URL_RE.search(msg):
         score += 3
-        if any(k in msg for k in ["verify", "bank", "account", "login", "click"]):
+        if any(k in msg for k in LINK_CONTEXT_KEYWORDS):
             score += 6
 
     # RAW PATTERNS
-    if re.search(UPI_REGEX, msg): score += 6
-    if re.search(PHONE_REGEX, msg): score += 2
+    if "@" in msg and UPI_RE.search(msg): score += 6
+    if PHONE_RE.search(msg): score += 2
 
-    confidence = min(score / 12, 1.0)
+    confidence = min(score / FULL_CONFIDENCE_SCORE, 1.0)
     return score >= 5, confidence
 
+# Pure function of the normalized text, so repeated lures are served from cache
+DETECT_CACHE_MAX_LEN = 1024
+detect_cached = functools.lru_cache(maxsize=4096)(detect_normalized)
+
 # =========================================================
 # INTELLIGENCE EXTRACTION
 # =========================================================
-def extract_intel(text: str):
+# Regexes run on the original text so links keep their case; keywords need
+# the lowercased form, which callers pass in when they already have it.
+def extract_intel(text: str, text_lower: Optional[str] = None):
+    if text_lower is None:
+        text_lower = text.lower()
     return {
-        "bankAccounts": [],
-        "upiIds": re.findall(UPI_REGEX, text),
-        "phishingLinks": re.findall(URL_REGEX, text),
-        "phoneNumbers": re.findall(PHONE_REGEX, text),
-        "suspiciousKeywords": [
-            k for k in [
-                "otp","upi","verify","account blocked",
-                "urgent","immediately","click","bank"
-            ] if k in text.lower()
-        ]
+        "bankAccounts": set(),
+        "upiIds": {m.group() for m in UPI_RE.finditer(text)} if "@" in text else set(),
+        "phishingLinks": {m.group() for m in URL_RE.finditer(text)},
+        "phoneNumbers": {m.group() for m in PHONE_RE.finditer(text)},
+        "suspiciousKeywords": {k for k in SUSPICIOUS_KEYWORDS if k in text_lower}
     }
 
 def agent_reply():
@@ -99,23 +178,46 @@ def agent_reply():
 # =========================================================
 # MAIN HACKATHON API (POST /)
 # =========================================================
+# The session is marked sent when this is scheduled so later turns don't queue
+# duplicates while it's in flight; a failure clears the mark so the next scam
+# turn retries, as the old synchronous call did.
+async def send_callback(session_id: str, payload: dict):
+    async with CALLBACK_LIMIT:
+        try:
+            await CALLBACK_CLIENT.post(
+                GUVI_CALLBACK,
+                content=orjson.dumps(payload),
+                headers={"Content-Type": "application/json"}
+            )
+        except Exception:
+            SESSION_CALLBACK_SENT.pop(session_id, None)
+
 @app.post("/")
 async def hackathon_api(req: HackathonRequest, x_api_key: str = Header(None)):
-    if x_api_key != API_KEY:
+    if not api_key_valid(x_api_key):
         raise HTTPException(status_code=401)
 
     STATS["total"] += 1
     session_id = req.sessionId
-    scam, _ = detect(req.message.text)
-
-    if session_id not in SESSION_INTEL:
-        SESSION_INTEL[session_id] = extract_intel("")
+    text_lower = req.message.text.lower()
+    scam, _ = detect(text_lower, lowered=True)
 
-    combined = req.message.text + " " + " ".join(m.text for m in req.conversationHistory)
-    intel = extract_intel(combined)
+    session = SESSION_INTEL.get(session_id)
+    if session is not None:
+        # Earlier turns were scanned when they arrived; only the new one is unseen
+        intel = extract_intel(req.message.text, text_lower)
+        for k in intel:
+            session[k].update(intel[k])
+        SESSION_INTEL[session_id] = session
+    else:
+        # New (or expired) session: replay whatever history the client sent
+        history = " ".join(m.text for m in req.conversationHistory)
+        session = SESSION_INTEL[session_id] = extract_intel(
+            req.message.text + " " + history, text_lower + " " + history.lower()
+        )
 
-    for k in intel:
-        SESSION_INTEL[session_id][k] = list(set(SESSION_INTEL[session_id][k] + intel[k]))
+    if session_id in SESSION_CALLBACK_SENT:
+        SESSION_CALLBACK_SENT[session_id] = True
 
     if scam:
         STATS["scam"] += 1
@@ -125,14 +227,13 @@ async def hackathon_api(req: HackathonRequest, x_api_key: str = Header(None)):
                 "sessionId": session_id,
                 "scamDetected": True,
                 "totalMessagesExchanged": len(req.conversationHistory) + 1,
-                "extractedIntelligence": SESSION_INTEL[session_id],
+                "extractedIntelligence": {k: list(v) for k, v in session.items()},
                 "agentNotes": "OTP + UPI + phishing + urgency scam detected"
             }
-            try:
-                requests.post(GUVI_CALLBACK, json=payload, timeout=5)
-                SESSION_CALLBACK_SENT.add(session_id)
-            except:
-                pass
+            task = asyncio.create_task(send_callback(session_id, payload))
+            PENDING_CALLBACKS.add(task)
+            task.add_done_callback(PENDING_CALLBACKS.discard)
+            SESSION_CALLBACK_SENT[session_id] = True
 
         return {"status": "success", "reply": agent_reply()}
 
@@ -142,9 +243,7 @@ async def hackathon_api(req: HackathonRequest, x_api_key: str = Header(None)):
 # =========================================================
 # HOME – OLD DARK UI RESTORED
 # =========================================================
-@app.get("/", response_class=HTMLResponse)
-def home():
-    return """
+HOME_HTML = """
 <!DOCTYPE html>
 <html>
 <head>
@@ -169,14 +268,16 @@ a:hover{transform:scale(1.08)}
 </div>
 </body>
 </html>
-"""
+""".encode()
+
+@app.get("/", response_class=HTMLResponse)
+async def home():
+    return HTMLResponse(HOME_HTML)
 
 # =========================================================
 # USER UI (OLD STYLE)
 # =========================================================
-@app.get("/user", response_class=HTMLResponse)
-def user():
-    return """
+USER_HTML = """
 <!DOCTYPE html>
 <html>
 <head>
@@ -215,14 +316,16 @@ async function go(){
 </div>
 </body>
 </html>
-"""
+""".encode()
+
+@app.get("/user", response_class=HTMLResponse)
+async def user():
+    return HTMLResponse(USER_HTML)
 
 # =========================================================
 # ADMIN UI (LIVE STATS)
 # =========================================================
-@app.get("/admin", response_class=HTMLResponse)
-def admin():
-    return f"""
+ADMIN_TEMPLATE = """
 <!DOCTYPE html>
 <html>
 <head>
@@ -235,9 +338,9 @@ body{{background:#020617;color:white;font-family:Arial;padding:40px}}
 <body>
 <h2>Admin Dashboard</h2>
 <div class="card">
-<p>Total Requests: {STATS['total']}</p>
-<p>Scams Detected: {STATS['scam']}</p>
-<p>Safe Messages: {STATS['safe']}</p>
+<p>Total Requests: {total}</p>
+<p>Scams Detected: {scam}</p>
+<p>Safe Messages: {safe}</p>
 </div>
 <br><p>Developed by Irfan Yasin</p>
 <a href="/">⬅ Back</a>
@@ -245,17 +348,21 @@ body{{background:#020617;color:white;font-family:Arial;padding:40px}}
 </html>
 """
 
+@app.get("/admin", response_class=HTMLResponse)
+async def admin():
+    return HTMLResponse(ADMIN_TEMPLATE.format_map(STATS))
+
 # =========================================================
 # HONEYPOT API (CURL / UI)
 # =========================================================
 @app.post("/honeypot", response_model=HoneypotResponse)
-def honeypot(data: HoneypotRequest, x_api_key: str = Header(None)):
-    if x_api_key != API_KEY:
+async def honeypot(data: HoneypotRequest, x_api_key: str = Header(None)):
+    if not api_key_valid(x_api_key):
         raise HTTPException(status_code=401)
 
     scam, conf = detect(data.message)
-    return HoneypotResponse(
-        scam_detected=scam,
-        confidence=conf,
-        reply="Please explain further" if scam else "Message looks safe"
-    )
+    return {
+        "scam_detected": scam,
+        "confidence": conf,
+        "reply": "Please explain further" if scam else "Message looks safe"
+    }